@@ -0,0 +1,187 @@
+import boto3
+import json
+import os
+from datetime import datetime, timezone
+from botocore.exceptions import ClientError
+from dynamodb_retry import MAX_ATTEMPTS, transact_with_retry
+from inventory_allocation import LEDGER_SHARDS, bucket_update, read_allocation, unallocated_update
+
+dynamodb_client = boto3.client('dynamodb')
+
+INVENTORY_TABLE = os.environ['INVENTORY_TABLE']
+LEDGER_TABLE = os.environ.get('LEDGER_TABLE', 'InventoryLedgerTable')
+
+# One action per ledger entry plus the stock update must fit in a transaction
+ENTRIES_PER_TRANSACTION = 99
+
+def pending_entries_from_stream(records):
+    """Extract newly appended ledger entries from DynamoDB stream records"""
+    entries = []
+    for record in records:
+        if record['eventName'] != 'INSERT':
+            continue
+        new_image = record['dynamodb']['NewImage']
+        entries.append({
+            'LedgerKey': new_image['LedgerKey']['S'],
+            'EntryId': new_image['EntryId']['S'],
+            'ItemName': new_image['ItemName']['S'],
+            'Quantity': int(new_image['Quantity']['N'])
+        })
+    return entries
+
+def pending_entries_from_index():
+    """Scan the sparse pending index for entries the stream path has not compacted"""
+    entries = []
+    scan = {'TableName': LEDGER_TABLE, 'IndexName': 'PendingIndex'}
+    while True:
+        response = dynamodb_client.scan(**scan)
+        for item in response['Items']:
+            entries.append({
+                'LedgerKey': item['LedgerKey']['S'],
+                'EntryId': item['EntryId']['S'],
+                'ItemName': item['ItemName']['S'],
+                'Quantity': int(item['Quantity']['N'])
+            })
+        if 'LastEvaluatedKey' not in response:
+            return entries
+        scan['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def compact_transaction(item_name, entries):
+    """Fold entries into stock and mark them compacted in one transaction.
+
+    Returns None on success, otherwise the cancellation reason codes.
+    """
+    compacted_at = datetime.now(timezone.utc).isoformat()
+    transact_items = [{
+        'Update': {
+            'TableName': INVENTORY_TABLE,
+            'Key': {'ItemName': {'S': item_name}},
+            'UpdateExpression': 'ADD Stock :delta',
+            'ExpressionAttributeValues': {
+                ':delta': {'N': str(sum(entry['Quantity'] for entry in entries))}
+            }
+        }
+    }]
+    for entry in entries:
+        transact_items.append({
+            'Update': {
+                'TableName': LEDGER_TABLE,
+                'Key': {
+                    'LedgerKey': {'S': entry['LedgerKey']},
+                    'EntryId': {'S': entry['EntryId']}
+                },
+                'UpdateExpression': 'REMOVE PendingItem SET CompactedAt = :compacted_at',
+                'ConditionExpression': 'attribute_exists(PendingItem)',
+                'ExpressionAttributeValues': {':compacted_at': {'S': compacted_at}}
+            }
+        })
+    return transact_with_retry(dynamodb_client, transact_items)
+
+def compact_item(item_name, entries):
+    """Compact an item's entries, skipping any that an earlier attempt already applied"""
+    compacted = 0
+    for i in range(0, len(entries), ENTRIES_PER_TRANSACTION):
+        batch = entries[i:i + ENTRIES_PER_TRANSACTION]
+        reasons = compact_transaction(item_name, batch)
+        if reasons is None:
+            compacted += len(batch)
+            continue
+        # Ledger updates follow the stock update; only a failed condition on a
+        # ledger row means part of the batch was already compacted (stream retry
+        # or sweep overlap). Anything else fails the invocation so it is retried.
+        if 'ConditionalCheckFailed' not in reasons[1:]:
+            raise RuntimeError(f"Compaction cancelled for {item_name}: {reasons}")
+        for entry in batch:
+            entry_reasons = compact_transaction(item_name, [entry])
+            if entry_reasons is None:
+                compacted += 1
+            elif entry_reasons[1:] == ['ConditionalCheckFailed']:
+                print(f"Ledger entry {entry['EntryId']} already compacted")
+            else:
+                raise RuntimeError(f"Compaction cancelled for {entry['EntryId']}: {entry_reasons}")
+    print(f"Compacted {compacted} ledger entries into stock for {item_name}")
+    return compacted
+
+def backfill_unallocated(item_name):
+    """Seed Unallocated from Stock for items created before allocation buckets existed"""
+    try:
+        dynamodb_client.update_item(
+            TableName=INVENTORY_TABLE,
+            Key={'ItemName': {'S': item_name}},
+            UpdateExpression='SET Unallocated = Stock',
+            ConditionExpression='attribute_exists(Stock) AND attribute_not_exists(Unallocated)'
+        )
+        print(f"Backfilled unallocated stock for {item_name}")
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+
+def rebalance_item(item_name):
+    """Spread an item's free units evenly across its allocation buckets.
+
+    Free units are the unallocated units plus every bucket's Available, which
+    always equals the compacted Stock plus the ledger deltas not yet compacted.
+    """
+    for attempt in range(MAX_ATTEMPTS):
+        unallocated, buckets = read_allocation(dynamodb_client, item_name)
+        base, extra = divmod(unallocated + sum(buckets.values()), LEDGER_SHARDS)
+        transact_items = []
+        for shard, available in buckets.items():
+            delta = base + (1 if shard < extra else 0) - available
+            if delta:
+                transact_items.append(bucket_update(item_name, shard, delta))
+        if unallocated:
+            transact_items.append(unallocated_update(item_name, -unallocated))
+        if not transact_items:
+            return
+
+        reasons = transact_with_retry(dynamodb_client, transact_items)
+        if reasons is None:
+            print(f"Rebalanced {item_name}: {base} units per bucket, {extra} with one extra")
+            return
+        if 'ConditionalCheckFailed' not in reasons:
+            raise RuntimeError(f"Rebalance cancelled for {item_name}: {reasons}")
+        # A reservation took units mid-rebalance; read again
+    print(f"Rebalance of {item_name} kept losing to reservations, leaving it for the next sweep")
+
+def inventory_item_names():
+    """List every item in the inventory table"""
+    item_names = []
+    scan = {'TableName': INVENTORY_TABLE, 'ProjectionExpression': 'ItemName'}
+    while True:
+        response = dynamodb_client.scan(**scan)
+        item_names.extend(item['ItemName']['S'] for item in response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            return item_names
+        scan['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def lambda_handler(event, context):
+    if 'Records' in event:
+        entries = pending_entries_from_stream(event['Records'])
+    else:
+        # Scheduled sweep
+        entries = pending_entries_from_index()
+
+    entries_by_item = {}
+    for entry in entries:
+        entries_by_item.setdefault(entry['ItemName'], []).append(entry)
+
+    compacted = 0
+    for item_name, item_entries in entries_by_item.items():
+        compacted += compact_item(item_name, item_entries)
+
+    if 'Records' in event:
+        # Refill the buckets this batch drew down
+        rebalance_items = list(entries_by_item)
+    else:
+        # The sweep also backfills and rebalances items with no recent activity
+        rebalance_items = inventory_item_names()
+        for item_name in rebalance_items:
+            backfill_unallocated(item_name)
+    for item_name in rebalance_items:
+        rebalance_item(item_name)
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps(f'Compacted {compacted} ledger entries, rebalanced {len(rebalance_items)} items')
+    }
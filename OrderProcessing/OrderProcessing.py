@@ -1,48 +1,252 @@
 import boto3
 import json
 import os
-from botocore.exceptions import ClientError
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from dynamodb_retry import MAX_ATTEMPTS, batch_get_with_retry, transact_with_retry
+from inventory_allocation import bucket_update, home_shard, read_allocation, unallocated_update
 
 dynamodb = boto3.resource('dynamodb')
+dynamodb_client = boto3.client('dynamodb')
 sqs = boto3.client('sqs')
 
-INVENTORY_TABLE = os.environ['INVENTORY_TABLE']
 FULFILLMENT_QUEUE_URL = os.environ['SQS_QUEUE_URL']
 ORDERS_TABLE = os.environ.get('ORDERS_TABLE', 'OrdersTable')
+LEDGER_TABLE = os.environ.get('LEDGER_TABLE', 'InventoryLedgerTable')
+
+# DynamoDB transactions accept at most 100 actions. A reservation takes two per
+# item (bucket update and ledger entry); a rollback also checks the reservation
+RESERVATION_CHUNK_SIZE = 50
+RELEASE_CHUNK_SIZE = 33
+RESERVATION_WORKERS = int(os.environ.get('RESERVATION_WORKERS', '8'))
 
-inventory_table = dynamodb.Table(INVENTORY_TABLE)
 orders_table = dynamodb.Table(ORDERS_TABLE)
 
-def item_available(item_name, quantity=1):
-    """Check if item is available in inventory"""
-    try:
-        response = inventory_table.get_item(Key={'ItemName': item_name})
-        item = response.get('Item')
-        if item and int(item.get('Stock', 0)) >= quantity:
+class ReservationError(Exception):
+    """Raised when a reservation fails for a reason other than short stock"""
+
+def chunk_item_counts(item_counts, size=RESERVATION_CHUNK_SIZE):
+    """Split item counts into chunks that fit in a single DynamoDB transaction"""
+    entries = list(item_counts.items())
+    return [dict(entries[i:i + size]) for i in range(0, len(entries), size)]
+
+def ledger_key(order_id, item_name, entry_type):
+    """Ledger key for an order's entry, derived from the order so redelivery cannot apply twice"""
+    return {
+        'LedgerKey': {'S': f"{item_name}#{home_shard(order_id)}"},
+        'EntryId': {'S': f"{order_id}#{item_name}#{entry_type}"}
+    }
+
+def ledger_put(order_id, item_name, quantity, entry_type):
+    """Build a ledger Put that fails if the entry was already written"""
+    key = ledger_key(order_id, item_name, entry_type)
+    return {
+        'Put': {
+            'TableName': LEDGER_TABLE,
+            'Item': {
+                **key,
+                'ItemName': {'S': item_name},
+                'PendingItem': key['LedgerKey'],
+                'Quantity': {'N': str(quantity)},
+                'OrderId': {'S': order_id},
+                'EntryType': {'S': entry_type},
+                'CreatedAt': {'S': datetime.now(timezone.utc).isoformat()}
+            },
+            'ConditionExpression': 'attribute_not_exists(EntryId)'
+        }
+    }
+
+def rolled_back_items(order_id, item_names):
+    """Return the items whose reservation for this order was already rolled back"""
+    responses = batch_get_with_retry(dynamodb_client, {LEDGER_TABLE: {
+        'Keys': [ledger_key(order_id, item_name, 'Rollback') for item_name in item_names],
+        'ProjectionExpression': 'ItemName',
+        'ConsistentRead': True
+    }})
+    return {entry['ItemName']['S'] for entry in responses.get(LEDGER_TABLE, [])}
+
+def check_recorded(order_id, item_names):
+    """Split items whose Reservation already exists into still-held and rolled-back"""
+    released = rolled_back_items(order_id, item_names)
+    if released:
+        print(f"Reservation for order {order_id} was already rolled back for {sorted(released)}")
+    return [item_name for item_name in item_names if item_name not in released], released
+
+def reserve_split(order_id, item_name, quantity):
+    """Reserve an item its home bucket cannot cover, drawing on the other sources.
+
+    Takes from the home bucket first, then the item's unallocated units, then
+    the fullest other buckets. Returns True once the units are reserved.
+    """
+    shard = home_shard(order_id)
+    for attempt in range(MAX_ATTEMPTS):
+        unallocated, buckets = read_allocation(dynamodb_client, item_name)
+        if unallocated + sum(buckets.values()) < quantity:
+            return False
+
+        transact_items = []
+        remaining = quantity
+        take = min(remaining, buckets.pop(shard))
+        if take > 0:
+            transact_items.append(bucket_update(item_name, shard, -take))
+            remaining -= take
+        take = min(remaining, unallocated)
+        if take > 0:
+            transact_items.append(unallocated_update(item_name, -take))
+            remaining -= take
+        for other_shard, available in sorted(buckets.items(), key=lambda bucket: -bucket[1]):
+            take = min(remaining, available)
+            if take <= 0:
+                break
+            transact_items.append(bucket_update(item_name, other_shard, -take))
+            remaining -= take
+        transact_items.append(ledger_put(order_id, item_name, -quantity, 'Reservation'))
+
+        reasons = transact_with_retry(dynamodb_client, transact_items)
+        if reasons is None:
+            print(f"Reserved {quantity} of {item_name} across {len(transact_items) - 1} sources")
             return True
-    except Exception as e:
-        print(f"Error checking inventory for {item_name}: {e}")
+        if reasons[-1] == 'ConditionalCheckFailed':
+            held, _ = check_recorded(order_id, [item_name])
+            return bool(held)
+        if 'ConditionalCheckFailed' not in reasons:
+            raise ReservationError(f"Reservation cancelled for {item_name}: {reasons}")
+        # A source moved under us (another order or a rebalance); read again
+        print(f"Allocation for {item_name} changed during reservation, retrying")
     return False
 
-def reserve_inventory(item_name, quantity=1):
-    """Reserve inventory by decrementing stock"""
-    try:
-        response = inventory_table.update_item(
-            Key={'ItemName': item_name},
-            UpdateExpression='ADD Stock :val',
-            ExpressionAttributeValues={':val': -quantity},
-            ConditionExpression='Stock >= :val',
-            ReturnValues='UPDATED_NEW'
-        )
-        new_stock = response['Attributes']['Stock']
-        print(f"Reserved {quantity} of {item_name}. New stock: {new_stock}")
-        return True
-    except ClientError as e:
-        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
-            print(f"Insufficient stock for {item_name}")
-            return False
-        print(f"Error reserving inventory for {item_name}: {e}")
-        return False
+def reserve_chunk(order_id, chunk):
+    """Reserve a chunk from its home buckets, splitting items the home bucket can't cover.
+
+    Returns the reserved items and the descriptions of items that could not be
+    reserved.
+    """
+    shard = home_shard(order_id)
+    pending = dict(chunk)
+    reserved = {}
+    unavailable_items = []
+    short = {}
+    while pending:
+        transact_items = []
+        for item_name, quantity in pending.items():
+            transact_items.append(bucket_update(item_name, shard, -quantity))
+            transact_items.append(ledger_put(order_id, item_name, -quantity, 'Reservation'))
+        reasons = transact_with_retry(dynamodb_client, transact_items)
+        if reasons is None:
+            reserved.update(pending)
+            break
+        if 'ConditionalCheckFailed' not in reasons:
+            raise ReservationError(f"Reservation cancelled for {list(pending)}: {reasons}")
+
+        # Bucket updates sit at even positions and ledger Puts at odd ones. A
+        # failed ledger condition means an earlier delivery of this order
+        # already wrote the entry; a failed bucket condition means short stock.
+        retry = {}
+        recorded = []
+        for (item_name, quantity), bucket_reason, ledger_reason in zip(
+                pending.items(), reasons[0::2], reasons[1::2]):
+            if ledger_reason == 'ConditionalCheckFailed':
+                recorded.append(item_name)
+            elif bucket_reason == 'ConditionalCheckFailed':
+                short[item_name] = quantity
+            else:
+                retry[item_name] = quantity
+        if recorded:
+            held, released = check_recorded(order_id, recorded)
+            reserved.update({item_name: pending[item_name] for item_name in held})
+            unavailable_items.extend(f"{item_name} (need {pending[item_name]})" for item_name in released)
+        pending = retry
+
+    for item_name, quantity in short.items():
+        if reserve_split(order_id, item_name, quantity):
+            reserved[item_name] = quantity
+        else:
+            unavailable_items.append(f"{item_name} (need {quantity})")
+    print(f"Reserved {len(reserved)} of {len(chunk)} items for order {order_id}")
+    return reserved, unavailable_items
+
+def release_actions(order_id, item_name, quantity):
+    """Build a rollback that applies only if the reservation exists and wasn't rolled back"""
+    return [
+        {
+            'ConditionCheck': {
+                'TableName': LEDGER_TABLE,
+                'Key': ledger_key(order_id, item_name, 'Reservation'),
+                'ConditionExpression': 'attribute_exists(EntryId)'
+            }
+        },
+        ledger_put(order_id, item_name, quantity, 'Rollback'),
+        bucket_update(item_name, home_shard(order_id), quantity)
+    ]
+
+def release_chunk(order_id, chunk):
+    """Roll back the chunk's reserved items, skipping items with nothing to roll back"""
+    transact_items = []
+    for item_name, quantity in chunk.items():
+        transact_items.extend(release_actions(order_id, item_name, quantity))
+    reasons = transact_with_retry(dynamodb_client, transact_items)
+    if reasons is None:
+        print(f"Rolled back reservation for {list(chunk)}")
+        return
+    if 'ConditionalCheckFailed' not in reasons:
+        raise RuntimeError(f"Rollback cancelled for {list(chunk)}: {reasons}")
+
+    # Some items were never reserved or are already rolled back; release the rest one by one
+    for item_name, quantity in chunk.items():
+        item_reasons = transact_with_retry(dynamodb_client, release_actions(order_id, item_name, quantity))
+        if item_reasons is None:
+            print(f"Rolled back reservation for {item_name}")
+        elif 'ConditionalCheckFailed' not in item_reasons[:2]:
+            raise RuntimeError(f"Rollback cancelled for {item_name}: {item_reasons}")
+
+def release_items(order_id, item_counts):
+    """Roll back reserved items, recording and re-raising any rollback that fails"""
+    chunks = chunk_item_counts(item_counts, size=RELEASE_CHUNK_SIZE)
+    with ThreadPoolExecutor(max_workers=RESERVATION_WORKERS) as executor:
+        futures = [executor.submit(release_chunk, order_id, chunk) for chunk in chunks]
+    failed_chunks = [chunk for chunk, future in zip(chunks, futures) if future.exception()]
+    if failed_chunks:
+        # Record the leaked reservation for reconciliation and fail the record so the
+        # stream redelivers it and the rollback is attempted again
+        leaked_items = ", ".join(item_name for chunk in failed_chunks for item_name in chunk)
+        update_order_status(order_id, 'Failed', f'Inventory rollback failed for: {leaked_items}')
+        raise futures[chunks.index(failed_chunks[0])].exception()
+
+def reserve_inventory(order_id, item_counts):
+    """Reserve all chunks concurrently, rolling back reserved items if any chunk fails.
+
+    Returns the items that could not be reserved, empty on success. Raises
+    ReservationError if a chunk failed for any reason other than short stock.
+    """
+    chunks = chunk_item_counts(item_counts)
+    with ThreadPoolExecutor(max_workers=RESERVATION_WORKERS) as executor:
+        futures = [executor.submit(reserve_chunk, order_id, chunk) for chunk in chunks]
+
+    errors = [future.exception() for future in futures if future.exception()]
+    reserved = {}
+    unavailable_items = []
+    for future in futures:
+        if not future.exception():
+            chunk_reserved, chunk_unavailable = future.result()
+            reserved.update(chunk_reserved)
+            unavailable_items.extend(chunk_unavailable)
+    if not errors and not unavailable_items:
+        return []
+
+    # A chunk that raised may have reserved some of its items before failing;
+    # rollbacks only apply where a reservation exists, so release them all
+    release_items(order_id, item_counts if errors else reserved)
+
+    if errors:
+        raise ReservationError(str(errors[0])) from errors[0]
+    return unavailable_items
+
+def parse_item_counts(new_image):
+    """Read item counts from the compact ItemCounts attribute, falling back to the Items list"""
+    if 'ItemCounts' in new_image:
+        return {name: int(count) for name, count in json.loads(new_image['ItemCounts']['S']).items()}
+    return dict(Counter(json.loads(new_image['Items']['S'])))
 
 def update_order_status(order_id, status, reason=None):
     """Update order status in DynamoDB"""
@@ -72,68 +276,35 @@ def lambda_handler(event, context):
         if record['eventName'] == 'INSERT':
             new_image = record['dynamodb']['NewImage']
             order_id = new_image['OrderId']['S']
-            items = json.loads(new_image['Items']['S'])
+            item_counts = parse_item_counts(new_image)
             customer_name = new_image.get('CustomerName', {}).get('S', 'Unknown')
 
-            print(f"Processing new order {order_id} for {customer_name}: {items}")
+            print(f"Processing new order {order_id} for {customer_name}: "
+                  f"{len(item_counts)} distinct items, {sum(item_counts.values())} units")
 
-            # Count item quantities
-            item_counts = {}
-            for item in items:
-                item_counts[item] = item_counts.get(item, 0) + 1
+            # Reserve inventory; the conditional bucket updates reject short stock
+            try:
+                unavailable_items = reserve_inventory(order_id, item_counts)
+            except ReservationError as e:
+                print(f"Failed to reserve inventory for Order {order_id}: {e}")
+                update_order_status(order_id, 'Failed', 'Inventory reservation failed')
+                continue
 
-            # Check inventory availability
-            inventory_check_passed = True
-            unavailable_items = []
-            
-            for item_name, quantity in item_counts.items():
-                if not item_available(item_name, quantity):
-                    inventory_check_passed = False
-                    unavailable_items.append(f"{item_name} (need {quantity})")
-
-            if inventory_check_passed:
-                # Reserve inventory
-                reservation_successful = True
-                reserved_items = []
+            if not unavailable_items:
+                print(f"Inventory reserved for Order {order_id}, sending to fulfillment...")
+                
+                # Update order status
+                update_order_status(order_id, 'Processing')
                 
-                for item_name, quantity in item_counts.items():
-                    if reserve_inventory(item_name, quantity):
-                        reserved_items.append(item_name)
-                    else:
-                        reservation_successful = False
-                        # Rollback previously reserved items
-                        for rollback_item in reserved_items:
-                            rollback_quantity = item_counts[rollback_item]
-                            try:
-                                inventory_table.update_item(
-                                    Key={'ItemName': rollback_item},
-                                    UpdateExpression='ADD Stock :val',
-                                    ExpressionAttributeValues={':val': rollback_quantity}
-                                )
-                                print(f"Rolled back reservation for {rollback_item}")
-                            except Exception as e:
-                                print(f"Error rolling back {rollback_item}: {e}")
-                        break
-
-                if reservation_successful:
-                    print(f"Inventory reserved for Order {order_id}, sending to fulfillment...")
-                    
-                    # Update order status
-                    update_order_status(order_id, 'Processing')
-                    
-                    # Send to SQS for fulfillment
-                    sqs.send_message(
-                        QueueUrl=FULFILLMENT_QUEUE_URL,
-                        MessageBody=json.dumps({
-                            'order_id': order_id,
-                            'customer_name': customer_name,
-                            'items': items,
-                            'item_counts': item_counts
-                        })
-                    )
-                else:
-                    print(f"Failed to reserve inventory for Order {order_id}")
-                    update_order_status(order_id, 'Failed', 'Inventory reservation failed')
+                # Send to SQS for fulfillment
+                sqs.send_message(
+                    QueueUrl=FULFILLMENT_QUEUE_URL,
+                    MessageBody=json.dumps({
+                        'order_id': order_id,
+                        'customer_name': customer_name,
+                        'item_counts': item_counts
+                    })
+                )
             else:
                 print(f"Inventory NOT available for Order {order_id}: {unavailable_items}")
                 update_order_status(order_id, 'Failed', f'Items unavailable: {", ".join(unavailable_items)}')
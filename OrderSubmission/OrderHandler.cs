@@ -29,7 +29,7 @@ namespace OrderSubmission
                 {
                     ["OrderId"] = Guid.NewGuid().ToString(),
                     ["CustomerName"] = order?.CustomerName,
-                    ["Items"] = JsonSerializer.Serialize(order?.Items),
+                    ["ItemCounts"] = JsonSerializer.Serialize(CountItems(order?.Items)),
                     ["Status"] = "Pending",
                     ["OrderDate"] = DateTime.UtcNow.ToString("o")
 
@@ -52,6 +52,16 @@ namespace OrderSubmission
             }
         }
 
+        private static Dictionary<string, int> CountItems(List<string>? items)
+        {
+            var counts = new Dictionary<string, int>();
+            foreach (var item in items ?? new List<string>())
+            {
+                counts[item] = counts.GetValueOrDefault(item) + 1;
+            }
+            return counts;
+        }
+
         public class Order
         {
             public string? CustomerName { get; set; }
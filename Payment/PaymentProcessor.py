@@ -11,7 +11,11 @@ def lambda_handler(event, context):
         
         order_id = event.get('order_id')
         customer_name = event.get('customer_name')
-        items = event.get('items', [])
+        item_counts = event.get('item_counts')
+        if item_counts is None:
+            item_counts = {}
+            for item in event.get('items', []):
+                item_counts[item] = item_counts.get(item, 0) + 1
         
         if not order_id:
             raise ValueError("Missing order_id in event")
@@ -24,7 +28,8 @@ def lambda_handler(event, context):
             'monitor': 299.99
         }
         
-        total_amount = sum(item_prices.get(item.lower(), 50.0) for item in items)
+        total_amount = sum(item_prices.get(item.lower(), 50.0) * quantity
+                           for item, quantity in item_counts.items())
         
         # Simulate payment processing
         payment_result = process_payment(order_id, total_amount, customer_name)
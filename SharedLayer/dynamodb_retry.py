@@ -0,0 +1,56 @@
+import random
+import time
+from botocore.exceptions import ClientError
+
+# Retry policy for throttling and transaction conflicts
+MAX_ATTEMPTS = 5
+BASE_BACKOFF_SECONDS = 0.05
+RETRYABLE_ERRORS = {
+    'ThrottlingException',
+    'ProvisionedThroughputExceededException',
+    'RequestLimitExceeded',
+    'TransactionInProgressException',
+    'InternalServerError'
+}
+RETRYABLE_CANCELLATIONS = {'TransactionConflict', 'ThrottlingError', 'ProvisionedThroughputExceeded'}
+
+def backoff(attempt):
+    """Sleep with full-jitter exponential backoff"""
+    time.sleep(random.uniform(0, BASE_BACKOFF_SECONDS * 2 ** attempt))
+
+def transact_with_retry(client, transact_items):
+    """Run a transaction, retrying conflicts and throttling with backoff.
+
+    Returns None on success, or the cancellation reason codes when the
+    transaction was cancelled for a reason retrying cannot fix.
+    """
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            client.transact_write_items(TransactItems=transact_items)
+            return None
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            if code == 'TransactionCanceledException':
+                reasons = [reason.get('Code', 'None') for reason in e.response.get('CancellationReasons', [])]
+                if 'ConditionalCheckFailed' in reasons or not RETRYABLE_CANCELLATIONS.intersection(reasons):
+                    return reasons
+            elif code not in RETRYABLE_ERRORS:
+                raise
+            if attempt == MAX_ATTEMPTS - 1:
+                raise
+            print(f"Transaction attempt {attempt + 1} failed with {code}, retrying")
+            backoff(attempt)
+
+def batch_get_with_retry(client, request_items):
+    """Run BatchGetItem, backing off before re-requesting UnprocessedKeys"""
+    responses = {}
+    attempt = 0
+    while request_items:
+        response = client.batch_get_item(RequestItems=request_items)
+        for table, items in response['Responses'].items():
+            responses.setdefault(table, []).extend(items)
+        request_items = response.get('UnprocessedKeys')
+        if request_items:
+            backoff(attempt)
+            attempt += 1
+    return responses
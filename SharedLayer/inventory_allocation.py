@@ -0,0 +1,63 @@
+import os
+import zlib
+from dynamodb_retry import batch_get_with_retry
+
+INVENTORY_TABLE = os.environ['INVENTORY_TABLE']
+ALLOCATION_TABLE = os.environ.get('ALLOCATION_TABLE', 'InventoryAllocationTable')
+LEDGER_SHARDS = int(os.environ.get('LEDGER_SHARDS', '10'))
+
+def home_shard(order_id):
+    """Shard an order's ledger entries and reservations land on"""
+    return zlib.crc32(order_id.encode()) % LEDGER_SHARDS
+
+def bucket_update(item_name, shard, quantity):
+    """Build an Available update on one allocation bucket, guarded when taking units"""
+    update = {
+        'Update': {
+            'TableName': ALLOCATION_TABLE,
+            'Key': {'BucketKey': {'S': f"{item_name}#{shard}"}},
+            'UpdateExpression': 'ADD Available :val',
+            'ExpressionAttributeValues': {':val': {'N': str(quantity)}}
+        }
+    }
+    if quantity < 0:
+        update['Update']['ConditionExpression'] = 'Available >= :qty'
+        update['Update']['ExpressionAttributeValues'][':qty'] = {'N': str(-quantity)}
+    return update
+
+def unallocated_update(item_name, quantity):
+    """Build an Unallocated update on the inventory item, guarded when taking units"""
+    update = {
+        'Update': {
+            'TableName': INVENTORY_TABLE,
+            'Key': {'ItemName': {'S': item_name}},
+            'UpdateExpression': 'ADD Unallocated :val',
+            'ExpressionAttributeValues': {':val': {'N': str(quantity)}}
+        }
+    }
+    if quantity < 0:
+        update['Update']['ConditionExpression'] = 'Unallocated >= :qty'
+        update['Update']['ExpressionAttributeValues'][':qty'] = {'N': str(-quantity)}
+    return update
+
+def read_allocation(client, item_name):
+    """Consistently read an item's unallocated units and per-shard bucket balances"""
+    responses = batch_get_with_retry(client, {
+        INVENTORY_TABLE: {
+            'Keys': [{'ItemName': {'S': item_name}}],
+            'ProjectionExpression': 'Unallocated',
+            'ConsistentRead': True
+        },
+        ALLOCATION_TABLE: {
+            'Keys': [{'BucketKey': {'S': f"{item_name}#{shard}"}} for shard in range(LEDGER_SHARDS)],
+            'ProjectionExpression': 'BucketKey, Available',
+            'ConsistentRead': True
+        }
+    })
+    unallocated = sum(int(item.get('Unallocated', {}).get('N', 0))
+                      for item in responses.get(INVENTORY_TABLE, []))
+    buckets = {shard: 0 for shard in range(LEDGER_SHARDS)}
+    for bucket in responses.get(ALLOCATION_TABLE, []):
+        shard = int(bucket['BucketKey']['S'].rsplit('#', 1)[1])
+        buckets[shard] = int(bucket.get('Available', {}).get('N', 0))
+    return unallocated, buckets
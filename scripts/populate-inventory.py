@@ -28,6 +28,8 @@ def populate_inventory():
     
     success_count = 0
     for item in inventory_items:
+        # New stock starts unallocated; the compaction sweep spreads it across buckets
+        item['Unallocated'] = item['Stock']
         try:
             table.put_item(Item=item)
             print(f"✅ Added {item['ItemName']}: {item['Stock']} units at ${item['Price']}")
@@ -50,5 +52,13 @@ def populate_inventory():
     except Exception as e:
         print(f"⚠️  Could not verify inventory: {e}")
 
+    # Spread the new stock across allocation buckets now instead of waiting for the sweep
+    try:
+        print("\n📦 Allocating stock to reservation buckets...")
+        response = boto3.client('lambda').invoke(FunctionName='InventoryCompaction', Payload=b'{}')
+        print(f"  {json.loads(response['Payload'].read()).get('body')}")
+    except Exception as e:
+        print(f"⚠️  Could not run allocation, it will happen on the next scheduled sweep: {e}")
+
 if __name__ == "__main__":
     populate_inventory()
\ No newline at end of file